@@ -1,23 +1,92 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, StringConstraints
+from typing import Annotated
+from contextlib import asynccontextmanager
+import anyio.to_thread
 import httpx
 import asyncio
+import hashlib
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import orjson
 import os
+import random
+import time
+import redis.asyncio as aioredis
+from cachetools import TTLCache
+
+# 📝 Handlers only enqueue records; a listener thread does the actual stderr
+# writes so the event loop never blocks on them
+_log_queue = queue.SimpleQueue()
+_queue_handler = QueueHandler(_log_queue)
+# Only merge args here; the listener's handler adds the timestamp and level
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_handler)
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    handlers=[_queue_handler]
+)
+logger = logging.getLogger("melody")
+# httpx logs every request at INFO, which would include each fallback poll
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# 🧵 Headroom for any sync dependency or blocking call (anyio's default is 40)
+THREADPOOL_SIZE = 200
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _log_listener.start()
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    # ✅ One pooled client for every Suno call (keeps TCP + TLS connections warm)
+    app.state.suno_client = httpx.AsyncClient(
+        base_url=SUNO_BASE_URL,
+        headers=HEADERS,
+        http2=True,
+        timeout=SUNO_TIMEOUT,
+        limits=SUNO_LIMITS,
+    )
+    app.state.redis = (
+        aioredis.Redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+    )
+    app.state.health = (float("-inf"), None)  # (checked_at, suno_status)
+    yield
+    # Stop background Suno waits before their client goes away
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    await app.state.suno_client.aclose()
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
+    _log_listener.stop()  # Flushes anything still queued
 
 app = FastAPI(
     title="Melody AI Backend",
     description="Generate music from prompts using Suno API",
-    version="1.1.0"
+    version="1.1.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # ✅ Allow frontend + backend domains (important for CORS)
+# Override with a comma-separated ALLOWED_ORIGINS env var
+DEFAULT_ORIGINS = [
+    "https://melodyai.edgeone.app",          # Your frontend domain
+    "https://melody-ai-backend.onrender.com" # Backend domain (for testing)
+]
+ALLOWED_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("ALLOWED_ORIGINS", ",".join(DEFAULT_ORIGINS)).split(",")
+    if origin.strip()
+]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=[
-        "https://melodyai.edgeone.app",          # Your frontend domain
-        "https://melody-ai-backend.onrender.com" # Backend domain (for testing)
-    ],
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -25,42 +94,224 @@ app.add_middleware(
 
 # ✅ Suno API setup
 API_KEY = os.getenv("SUNO_API_KEY")
-SUNO_API_URL = "https://api.sunoapi.org/api/v1/generate"
+SUNO_BASE_URL = "https://api.sunoapi.org"
+SUNO_GENERATE_PATH = "/api/v1/generate"
 HEADERS = {
     "Authorization": f"Bearer {API_KEY}",
     "Content-Type": "application/json"
 }
+SUNO_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+# ✅ Longer timeout for the generate POST: Suno can be slow to accept a job,
+# and timing out after it was sent risks paying for a duplicate on resubmit
+GENERATE_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+SUNO_LIMITS = httpx.Limits(max_keepalive_connections=20, max_connections=100)
+# Public URL Suno posts results to; defaults to this app's own /callback route
+CALLBACK_URL = os.getenv("CALLBACK_URL")
+# Fields that are the same for every generation request
+_PAYLOAD_BASE = {
+    "title": "Melody AI Track",
+    "customMode": True,
+    "instrumental": True,
+    "model": "V3_5",
+}
+# 🔁 Retries for the generate POST (full-jitter exponential backoff)
+GENERATE_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+# Cap on generate POSTs in flight to Suno at once
+SUNO_SEM = asyncio.Semaphore(20)
+
+# 🗄️ Set REDIS_URL so every worker shares results and the prompt cache;
+# without it both live in this process only
+REDIS_URL = os.getenv("REDIS_URL")
+MUSIC_TTL = 3600  # seconds
+CACHE_TTL = MUSIC_TTL  # A cached task must not outlive its stored track
+
+# 🎵 task_id -> audio URL, filled in by Suno's webhook (bounded, expires after 1h)
+music_store = TTLCache(maxsize=100_000, ttl=MUSIC_TTL)
+_store_lock = asyncio.Lock()
+# task_id -> event set once its track lands in music_store (for long-polling)
+pending_events: dict[str, asyncio.Event] = {}
+LONG_POLL_TIMEOUT = 25  # seconds
+SSE_HEARTBEAT = 15  # seconds
+
+async def _get_music_url(task_id: str) -> str | None:
+    if app.state.redis is not None:
+        return await app.state.redis.get(f"music:{task_id}")
+    return music_store.get(task_id)
+
+def _release_waiters(task_id: str):
+    """Wakes long-polls on this worker; nothing more will arrive for the task."""
+    if ev := pending_events.pop(task_id, None):
+        ev.set()
+
+async def _store_music(task_id: str, music_url: str) -> bool:
+    """Stores the first URL reported for a task; returns False for repeats."""
+    if app.state.redis is not None:
+        stored = bool(await app.state.redis.set(
+            f"music:{task_id}", music_url, ex=MUSIC_TTL, nx=True
+        ))
+    else:
+        async with _store_lock:
+            stored = music_store.setdefault(task_id, music_url) is music_url
+    _release_waiters(task_id)
+    return stored
+
+# 🔄 Fallback status polling (in case a webhook never arrives)
+POLL_FIRST_PROBE = 0.5  # fast tracks can be ready almost immediately
+POLL_BASE_DELAY = 1.0
+POLL_BACKOFF_RATE = 1.5
+POLL_MIN_DELAY = 0.5
+POLL_MAX_DELAY = 10.0
+POLL_TIMEOUT = 180  # seconds
+_background_tasks = set()
+
+# 💾 Identical prompts reuse the earlier Suno task instead of paying again
+music_cache = TTLCache(maxsize=10_000, ttl=CACHE_TTL)
+# Cache key -> future of the generation currently talking to Suno
+inflight: dict[str, asyncio.Future] = {}
+
+def _cache_key(prompt: str) -> str:
+    normalized = {"p": prompt.lower(), "m": "V3_5", "instr": True}
+    return hashlib.blake2b(
+        json.dumps(normalized, sort_keys=True).encode(), digest_size=16
+    ).hexdigest()
+
+async def _get_cached(key: str) -> dict | None:
+    if app.state.redis is not None:
+        raw = await app.state.redis.get(f"prompt:{key}")
+        return orjson.loads(raw) if raw else None
+    return music_cache.get(key)
+
+async def _set_cached(key: str, result: dict):
+    if app.state.redis is not None:
+        await app.state.redis.setex(f"prompt:{key}", CACHE_TTL, orjson.dumps(result))
+    else:
+        music_cache[key] = result
+
+async def _drop_cached(key: str):
+    if app.state.redis is not None:
+        await app.state.redis.delete(f"prompt:{key}")
+    else:
+        music_cache.pop(key, None)
 
 class MusicRequest(BaseModel):
-    prompt: str
+    # Stripped and length-checked during validation, before the handler runs
+    prompt: Annotated[
+        str, StringConstraints(strip_whitespace=True, min_length=1, max_length=2000)
+    ]
+
+class CallbackData(BaseModel):
+    id: Annotated[str, StringConstraints(max_length=128)] | None = None
+    audio_url: str | None = None
+
+def _parse_suno(response: httpx.Response) -> dict:
+    """
+    Checks status code and content type before decoding, so an HTML error
+    page from Suno is rejected without ever being parsed.
+    """
+    content_type = response.headers.get("content-type", "")
+    if response.status_code != 200 or not content_type.startswith("application/json"):
+        # Only decode the body to text when something went wrong
+        logger.warning(
+            "❌ Unexpected Suno response: %s %s %.500s",
+            response.status_code, content_type, response.text
+        )
+        raise HTTPException(status_code=502, detail="Unexpected response from Suno.")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("🔍 Raw Suno response: %s", response.content)
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError as e:
+        logger.error("❌ JSON decode error: %s %.500s", e, response.text)
+        raise HTTPException(status_code=500, detail="Failed to parse Suno response.")
 
 @app.post("/generate_music")
-async def generate_music(request: MusicRequest):
+async def generate_music(request: MusicRequest, http_request: Request):
     """
-    Accepts a music prompt, sends it to Suno API,
-    and waits for generated audio (up to 2 minutes).
+    Accepts a music prompt, sends it to Suno API and returns the task ID
+    right away. Suno posts the finished track to /callback; the frontend
+    reads it from /music/{task_id}.
     """
-    if not request.prompt.strip():
-        raise HTTPException(status_code=400, detail="Prompt cannot be empty.")
+    key = _cache_key(request.prompt)
+    if cached := await _get_cached(key):
+        return ORJSONResponse(cached)
+    # Same prompt already on its way to Suno: share that call's result.
+    # None means that request was cancelled, so try again ourselves.
+    while (pending := inflight.get(key)) is not None:
+        result = await asyncio.shield(pending)
+        if result is not None:
+            return ORJSONResponse(result)
+
+    fut = asyncio.get_running_loop().create_future()
+    inflight[key] = fut
+    callback_url = CALLBACK_URL or str(http_request.url_for("receive_music"))
+    try:
+        result = await _start_generation(request.prompt, callback_url, key)
+    except asyncio.CancelledError:
+        fut.set_result(None)  # Let waiters retry instead of inheriting this
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # Mark retrieved in case nobody else was waiting
+        raise
+    else:
+        fut.set_result(result)
+        return ORJSONResponse(result)
+    finally:
+        inflight.pop(key, None)
 
+async def _post_generate(payload: dict) -> dict:
+    """
+    Posts a generation request, retrying only failures where Suno cannot
+    have started a (paid) generation: connection errors, 429 and 5xx. Retries
+    use full-jitter backoff so concurrent replicas don't hammer Suno in
+    lock-step during an outage.
+    """
+    client = app.state.suno_client
+    for attempt in range(GENERATE_ATTEMPTS):
+        final_attempt = attempt == GENERATE_ATTEMPTS - 1
+        try:
+            async with SUNO_SEM:
+                response = await client.post(
+                    SUNO_GENERATE_PATH, json=payload, timeout=GENERATE_TIMEOUT
+                )
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            # The request never left this process, so retrying is safe
+            if final_attempt:
+                raise HTTPException(status_code=502, detail="Suno is unreachable.") from e
+            logger.warning("⚠️ Suno attempt %s failed: %s", attempt + 1, e)
+        except httpx.TransportError as e:
+            # Suno may already have accepted the job; a retry could bill twice
+            logger.warning("❌ Suno request failed after sending: %s", e)
+            raise HTTPException(status_code=502, detail="No response from Suno.") from e
+        else:
+            status = response.status_code
+            if status < 500 and status != 429:
+                # A bad prompt or API key won't get better by retrying
+                if status >= 400:
+                    logger.warning(
+                        "❌ Suno rejected request: %s %.500s", status, response.text
+                    )
+                    raise HTTPException(
+                        status_code=502, detail=f"Suno rejected the request ({status})."
+                    )
+                return _parse_suno(response)
+            if final_attempt:
+                return _parse_suno(response)  # Raises the 502 for us
+            logger.warning("⚠️ Suno attempt %s returned %s", attempt + 1, status)
+        backoff = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+        await asyncio.sleep(random.uniform(0, backoff))
+
+async def _start_generation(prompt: str, callback_url: str, key: str) -> dict:
+    """Submits one generation to Suno and schedules the fallback wait for it."""
     payload = {
-        "prompt": request.prompt,
-        "title": "Melody AI Track",
-        "customMode": True,
-        "instrumental": True,
-        "model": "V3_5",
-        "callBackUrl": None
+        **_PAYLOAD_BASE,
+        "prompt": prompt,
+        "callBackUrl": callback_url,
     }
 
-    # ✅ Increase timeout for initial request
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(SUNO_API_URL, json=payload, headers=HEADERS)
-
-        try:
-            data = response.json()
-        except Exception as e:
-            print(f"❌ JSON decode error: {e}")
-            raise HTTPException(status_code=500, detail="Failed to parse Suno response.")
+    data = await _post_generate(payload)
 
     # ✅ Handle rate limit (credits exhausted)
     if data.get("code") == 429:
@@ -74,43 +325,202 @@ async def generate_music(request: MusicRequest):
     if not task_id:
         raise HTTPException(status_code=500, detail="No task ID returned from Suno.")
 
-    print(f"✅ Task ID received: {task_id}")
-
-    # 🔄 Poll Suno for up to 180 seconds (3 minutes)
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        for _ in range(90):  # 90 retries × 2s = 180s
-            await asyncio.sleep(2)
-            poll_url = f"https://api.sunoapi.org/api/v1/status/{task_id}"
-            poll_resp = await client.get(poll_url, headers=HEADERS)
+    logger.info("✅ Task ID received: %s", task_id)
+    pending_events[task_id] = asyncio.Event()
+    task = asyncio.create_task(wait_for_suno(task_id, key))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    result = {"taskId": task_id, "music_url": None}
+    await _set_cached(key, result)
+    return result
 
+async def wait_for_suno(task_id: str, key: str):
+    """
+    Backup for a lost webhook: polls Suno's status endpoint with jittered
+    exponential backoff until the track is ready or the deadline passes.
+    """
+    delivered = False
+    try:
+        delivered = await _poll_until_ready(task_id)
+        if not delivered:
+            logger.warning("⏳ Gave up polling task %s after %ss", task_id, POLL_TIMEOUT)
+    except Exception:
+        logger.exception("❌ Waiting for task %s failed", task_id)
+    finally:
+        # Always wake long-polls, even if the store (e.g. Redis) failed
+        _release_waiters(task_id)
+        if not delivered:
+            # Don't hand this task out again for the same prompt
             try:
-                poll_data = poll_resp.json()
-            except Exception as e:
-                print("❌ Poll JSON error:", e)
-                continue
-
-            audio_url = poll_data.get("data", {}).get("audio_url")
-            if audio_url:
-                print(f"🎶 Music ready: {audio_url}")
-                return {"taskId": task_id, "music_url": audio_url}
-
-    # ❌ Still not ready after 3 minutes
-    return {
-        "taskId": task_id,
-        "music_url": None,
-        "message": "⏳ Music generation took too long. Try again."
-    }
+                await _drop_cached(key)
+            except Exception:
+                logger.exception("❌ Could not drop cached prompt for task %s", task_id)
+
+async def _poll_until_ready(task_id: str) -> bool:
+    """Returns True once the track is stored, False if the deadline passed."""
+    client = app.state.suno_client
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + POLL_TIMEOUT
+    index = 0
+    last_status = None
+    first_probe = True
+
+    while loop.time() < deadline:
+        if first_probe:
+            delay = POLL_FIRST_PROBE
+            first_probe = False
+        else:
+            upper = min(POLL_MAX_DELAY, POLL_BASE_DELAY * POLL_BACKOFF_RATE ** index)
+            delay = random.uniform(POLL_MIN_DELAY, upper)
+        await asyncio.sleep(delay)
+        if await _get_music_url(task_id):
+            return True  # Webhook got there first, possibly on another worker
+
+        try:
+            poll_resp = await client.get(f"/api/v1/status/{task_id}")
+            poll_data = _parse_suno(poll_resp)
+        except Exception as e:
+            logger.debug("❌ Poll error for %s: %s", task_id, e)
+            index += 1
+            continue
+
+        task_data = poll_data.get("data") or {}
+        audio_url = task_data.get("audio_url")
+        if audio_url:
+            await _store_music(task_id, audio_url)
+            logger.info("🎶 Music ready: %s", audio_url)
+            return True
+
+        # Reset the backoff whenever Suno reports progress
+        status = task_data.get("status")
+        if status and status != last_status:
+            last_status = status
+            index = 0
+        else:
+            index += 1
+
+    return False
+
+@app.post("/callback")
+async def receive_music(data: CallbackData):
+    """Webhook Suno calls once a generation has finished."""
+    logger.debug("🎧 Callback received: %s", data)
+    task_id = data.id
+    music_url = data.audio_url
+    if not (task_id and music_url):
+        return ORJSONResponse({"status": "error"})
+    # Suno retries webhooks; the first delivery wins
+    if not await _store_music(task_id, music_url):
+        return ORJSONResponse({"status": "duplicate"})
+    logger.info("🎶 Music ready: %s", music_url)
+    return ORJSONResponse({"status": "stored"})
+
+@app.get("/music/{task_id}")
+async def get_music(task_id: str, request: Request):
+    """
+    Long-polls for up to LONG_POLL_TIMEOUT seconds while the track is still
+    being generated, so the frontend needs one request instead of dozens.
+    A finished task never changes, so that answer is cacheable and
+    revalidated with an ETag.
+    """
+    music_url = await _get_music_url(task_id)
+    if not music_url and (ev := pending_events.get(task_id)):
+        try:
+            await asyncio.wait_for(ev.wait(), timeout=LONG_POLL_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass  # The callback may still have landed on another worker
+        music_url = await _get_music_url(task_id)
+
+    if music_url:
+        digest = hashlib.blake2b(music_url.encode(), digest_size=16).hexdigest()
+        etag = f'"{digest}"'
+        headers = {
+            "ETag": etag,
+            "Cache-Control": f"public, max-age={MUSIC_TTL}, immutable",
+        }
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return ORJSONResponse(
+            {"taskId": task_id, "music_url": music_url}, headers=headers
+        )
+    return ORJSONResponse(
+        {"taskId": task_id, "music_url": None, "message": "⏳ Still generating..."}
+    )
+
+async def _music_events(task_id: str):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + POLL_TIMEOUT
+    while loop.time() < deadline:
+        music_url = await _get_music_url(task_id)
+        if music_url:
+            yield f"event: ready\ndata: {music_url}\n\n"
+            return
+        ev = pending_events.get(task_id)
+        if ev is None:
+            if app.state.redis is None:
+                break  # Nothing in this process will ever deliver it
+            # Another worker owns the task; re-check Redis each heartbeat
+            await asyncio.sleep(SSE_HEARTBEAT)
+            yield ": heartbeat\n\n"
+            continue
+        try:
+            await asyncio.wait_for(ev.wait(), timeout=SSE_HEARTBEAT)
+        except asyncio.TimeoutError:
+            yield ": heartbeat\n\n"
+    yield "event: error\ndata: Music not available\n\n"
+
+@app.get("/music/{task_id}/stream")
+async def stream_music(task_id: str):
+    """
+    Server-sent events alternative to polling /music/{task_id}: sends a
+    `ready` event with the audio URL the moment it arrives.
+    """
+    return StreamingResponse(
+        _music_events(task_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+_HOME = ORJSONResponse({"message": "Backend is working!"})
 
 @app.get("/")
-def home():
-    return {"message": "Backend is working!"}
+async def home():
+    return _HOME
+
+# 🩺 Probes within HEALTH_TTL share the last upstream check
+HEALTH_TTL = 5.0  # seconds
+_health_lock = asyncio.Lock()
 
 @app.get("/health")
 async def health_check():
-    try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(SUNO_API_URL, headers=HEADERS)
-            status = "online" if response.status_code == 200 else "offline"
-    except:
-        status = "unreachable"
-    return {"suno_status": status}
+    checked_at, status = app.state.health
+    if time.monotonic() - checked_at < HEALTH_TTL:
+        return ORJSONResponse({"suno_status": status})
+
+    async with _health_lock:
+        # Another probe may have refreshed it while we waited for the lock
+        checked_at, status = app.state.health
+        if time.monotonic() - checked_at >= HEALTH_TTL:
+            try:
+                response = await app.state.suno_client.get(SUNO_GENERATE_PATH)
+                status = "online" if response.status_code == 200 else "offline"
+            except (httpx.HTTPError, asyncio.TimeoutError):
+                status = "unreachable"
+            app.state.health = (time.monotonic(), status)
+    return ORJSONResponse({"suno_status": status})
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # Workers keep separate in-process stores, so only fan out when
+    # results are shared through Redis
+    default_workers = (os.cpu_count() or 1) if REDIS_URL else 1
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", default_workers)),
+        loop="auto",  # uvloop when installed
+        http="auto",  # httptools when installed
+        log_level="warning",
+    )